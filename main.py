@@ -7,15 +7,24 @@ using OpenRouter (Mistral-7B) and LangChain for intelligent document Q&A.
 
 import streamlit as st
 import os
-import tempfile
+import asyncio
+import hashlib
+import httpx
 from pathlib import Path
 from dotenv import load_dotenv
 from utils.pdf_loader import PDFLoader
-from utils.qa_pipeline import QAPipeline
+from utils.qa_pipeline import QAPipeline, _get_embeddings
+from utils.embeddings import DEFAULT_EMBEDDING_MODEL
 
 # Load environment variables
 load_dotenv()
 
+QUICK_QUESTIONS = [
+    "What is the main topic?",
+    "Summarize key points",
+    "What are conclusions?"
+]
+
 
 def initialize_session_state():
     """Initialize Streamlit session state variables."""
@@ -27,6 +36,35 @@ def initialize_session_state():
         st.session_state.chunks = []
     if 'current_pdf_name' not in st.session_state:
         st.session_state.current_pdf_name = ""
+    if 'doc_hash' not in st.session_state:
+        st.session_state.doc_hash = ""
+    if 'quick_answers' not in st.session_state:
+        st.session_state.quick_answers = None
+    if 'quick_q_vectors' not in st.session_state:
+        st.session_state.quick_q_vectors = {}
+
+
+@st.cache_resource(show_spinner="Loading embedding model...")
+def get_embeddings():
+    """Warm up the process-wide embedding model once, keeping it across Streamlit reruns."""
+    embeddings = _get_embeddings(DEFAULT_EMBEDDING_MODEL)
+    embeddings.embed_query("warmup")
+    return embeddings
+
+
+@st.cache_resource(show_spinner=False)
+def get_http_client():
+    """Create a shared HTTP/2 client for the LLM API and open its connection early."""
+    client = httpx.Client(
+        base_url=os.getenv("LLM_BASE_URL", "https://openrouter.ai/api/v1"),
+        http2=True
+    )
+    try:
+        # Pay the TLS handshake now rather than on the first question
+        client.get("/models", headers={"Authorization": f"Bearer {os.getenv('OPENROUTER_API_KEY')}"})
+    except httpx.HTTPError:
+        pass
+    return client
 
 
 def setup_page():
@@ -147,34 +185,51 @@ def check_openrouter_key():
 
 def process_pdf(uploaded_file):
     """Process uploaded PDF file and set up QA pipeline."""
-    tmp_path = None
     try:
         # Validate file size (max 50MB)
         if uploaded_file.size > 50 * 1024 * 1024:
             st.error("❌ File size exceeds 50MB limit.")
             return None, None
         
-        # Save uploaded file temporarily
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
-            tmp_file.write(uploaded_file.getvalue())
-            tmp_path = tmp_file.name
+        pdf_bytes = uploaded_file.getvalue()
+        doc_hash = hashlib.sha256(pdf_bytes).hexdigest()[:16]
         
-        # Load and chunk PDF
+        # Load PDF straight from memory
         pdf_loader = PDFLoader()
-        chunks = pdf_loader.load_pdf(tmp_path)
-        
-        # Get chunk information
-        chunk_info = pdf_loader.get_chunk_info(chunks)
+        page_texts = pdf_loader.extract_pages_bytes(pdf_bytes)
         
-        # Set up QA pipeline
-        qa_pipeline = QAPipeline()
-        qa_chain = qa_pipeline.setup_qa_pipeline(chunks)
+        # Set up QA pipeline: whole document in context when it fits, retrieval otherwise
+        qa_pipeline = QAPipeline(embeddings=get_embeddings(), http_client=get_http_client())
+        token_count = sum(pdf_loader.count_tokens(text) for text in page_texts)
+        if qa_pipeline.fits_in_context(token_count):
+            # The full text is sent as a single unit, so there is nothing to chunk
+            document_text = "\n".join(page_texts)
+            chunks = [document_text]
+            qa_chain = qa_pipeline.setup_cag_pipeline(document_text)
+        else:
+            sections = pdf_loader.split_pages_with_headings(page_texts)
+            chunks = [chunk for _, chunk in sections]
+            qa_chain = qa_pipeline.setup_qa_pipeline(
+                chunks,
+                collection_name=f"pdf_{doc_hash}",
+                headings=[heading for heading, _ in sections],
+                document_prefix=pdf_loader.document_prefix(page_texts)
+            )
         
         # Update session state
         st.session_state.qa_pipeline = qa_pipeline
         st.session_state.chunks = chunks
         st.session_state.pdf_loaded = True
         st.session_state.current_pdf_name = uploaded_file.name
+        st.session_state.doc_hash = doc_hash
+        st.session_state.quick_answers = None
+        
+        # Embed all quick questions in one batched call
+        st.session_state.quick_q_vectors = dict(zip(QUICK_QUESTIONS, qa_pipeline.embed_questions(QUICK_QUESTIONS)))
+        
+        # Get chunk information
+        chunk_info = pdf_loader.get_chunk_info(chunks)
+        chunk_info["total_tokens"] = token_count
         
         return chunk_info, qa_pipeline.get_vector_store_info()
         
@@ -197,20 +252,40 @@ def process_pdf(uploaded_file):
     except Exception as e:
         st.error(f"❌ Error processing PDF: {str(e)}")
         return None, None
-    finally:
-        # Clean up temporary file
-        if tmp_path and os.path.exists(tmp_path):
-            try:
-                os.unlink(tmp_path)
-            except Exception:
-                pass
 
 
-def ask_question(question, qa_pipeline):
-    """Ask a question and return the answer."""
+def is_error_result(result):
+    """Check whether a result dictionary carries an error instead of an answer."""
+    return result["source_count"] == 0 and result["answer"].startswith("Error processing question")
+
+
+@st.cache_data(ttl=3600, max_entries=500, show_spinner=False)
+def _cached_answer(_qa_pipeline, doc_hash: str, normalized_question: str, _question: str, _q_vec=None) -> dict:
+    """Answer a question, cached per document content and normalized question across reruns and sessions."""
+    if _q_vec is not None:
+        # Reuse the precomputed embedding instead of embedding the question again
+        result = _qa_pipeline.query_with_vector(_question, _q_vec)
+    else:
+        result = _qa_pipeline.query_chain(_question)
+    if is_error_result(result):
+        # Raise so failed answers are not cached
+        raise RuntimeError(result["answer"])
+    return result
+
+
+def ask_question(question, qa_pipeline, q_vec=None):
+    """Ask a question and return the answer, using its embedding when already known."""
     try:
-        result = qa_pipeline.query_chain(question)
-        return result
+        # Normalize only the cache key so trivially different phrasings share an entry;
+        # the LLM still gets the original wording
+        normalized = " ".join(question.lower().split())
+        return _cached_answer(qa_pipeline, st.session_state.doc_hash, normalized, question.strip(), q_vec)
+    except RuntimeError as e:
+        return {
+            "answer": str(e),
+            "sources": [],
+            "source_count": 0
+        }
     except Exception as e:
         return {
             "answer": f"Error processing question: {str(e)}",
@@ -219,13 +294,52 @@ def ask_question(question, qa_pipeline):
         }
 
 
+def stream_answer(question, qa_pipeline, placeholder):
+    """Ask a question, rendering the answer into the placeholder as tokens arrive."""
+    partial = ""
+    
+    def on_token(token):
+        nonlocal partial
+        partial += token
+        placeholder.markdown(partial)
+    
+    try:
+        result = qa_pipeline.query_chain(question, on_token=on_token)
+    except Exception as e:
+        result = {
+            "answer": f"Error processing question: {str(e)}",
+            "sources": [],
+            "source_count": 0
+        }
+    
+    # Cached answers arrive without tokens; also replaces any partial output on errors
+    placeholder.markdown(result["answer"])
+    return result
+
+
+def prefetch_quick_answers(questions, qa_pipeline, question_vectors):
+    """Answer the quick questions concurrently and return the successful ones by question."""
+    async def answer(q):
+        if q in question_vectors:
+            return await qa_pipeline.aquery_with_vector(q, question_vectors[q])
+        return await qa_pipeline.aquery_chain(q)
+    
+    async def gather_answers():
+        return await asyncio.gather(*(answer(q) for q in questions))
+    
+    results = asyncio.run(gather_answers())
+    return {q: result for q, result in zip(questions, results) if not is_error_result(result)}
+
+
 def main():
     """Main application function."""
     initialize_session_state()
     setup_page()
     
-    # Check OpenRouter API key
-    check_openrouter_key()
+    # Check OpenRouter API key, then warm up the model and LLM connection
+    if check_openrouter_key():
+        get_embeddings()
+        get_http_client()
     
     # Compact sidebar
     with st.sidebar:
@@ -267,7 +381,11 @@ def main():
                                 st.metric("Chars", f"{chunk_info['total_characters']:,}")
                             with col2:
                                 st.metric("Avg Size", f"{chunk_info['avg_chunk_size']}")
-                                st.metric("Vectors", vector_info['total_documents'])
+                                if vector_info['total_documents']:
+                                    st.metric("Vectors", vector_info['total_documents'])
+                                else:
+                                    # Full-document mode: nothing is embedded
+                                    st.metric("Tokens", f"{chunk_info['total_tokens']:,}")
         
         # Compact document info
         if st.session_state.pdf_loaded:
@@ -284,7 +402,7 @@ def main():
                 if st.session_state.qa_pipeline:
                     st.session_state.qa_pipeline.clear_vector_store()
                 # Clear all session state
-                for key in ['qa_pipeline', 'pdf_loaded', 'chunks', 'current_pdf_name']:
+                for key in ['qa_pipeline', 'pdf_loaded', 'chunks', 'current_pdf_name', 'doc_hash', 'quick_answers', 'quick_q_vectors']:
                     if key in st.session_state:
                         del st.session_state[key]
                 st.rerun()
@@ -361,17 +479,16 @@ def main():
                 question = ""
         
         if question and ask_button:
+            # Compact answer display, filled in while the answer streams
+            st.markdown("""
+            <div class="answer-compact">
+                <div class="compact-title">💡 Answer</div>
+            </div>
+            """, unsafe_allow_html=True)
+            answer_placeholder = st.empty()
+            
             with st.spinner("🤔 Analyzing..."):
-                result = ask_question(question, st.session_state.qa_pipeline)
-                
-                # Compact answer display
-                st.markdown("""
-                <div class="answer-compact">
-                    <div class="compact-title">💡 Answer</div>
-                </div>
-                """, unsafe_allow_html=True)
-                
-                st.write(result["answer"])
+                result = stream_answer(question, st.session_state.qa_pipeline, answer_placeholder)
                 
                 # Compact sources display
                 if result["source_count"] > 0:
@@ -390,19 +507,26 @@ def main():
         </div>
         """, unsafe_allow_html=True)
         
-        col1, col2, col3 = st.columns(3)
+        # Answer all quick questions concurrently on first render. Skipped in full-document
+        # mode, where each answer sends the whole document, so they are only asked on click
+        if st.session_state.quick_answers is None:
+            if st.session_state.qa_pipeline.document_text is not None:
+                st.session_state.quick_answers = {}
+            else:
+                with st.spinner("⚡ Preparing quick answers..."):
+                    st.session_state.quick_answers = prefetch_quick_answers(
+                        QUICK_QUESTIONS, st.session_state.qa_pipeline, st.session_state.quick_q_vectors
+                    )
         
-        quick_questions = [
-            "What is the main topic?",
-            "Summarize key points",
-            "What are conclusions?"
-        ]
+        col1, col2, col3 = st.columns(3)
         
-        for i, q in enumerate(quick_questions):
+        for i, q in enumerate(QUICK_QUESTIONS):
             with [col1, col2, col3][i]:
                 if st.button(q, key=f"quick_{i}", use_container_width=True):
                     with st.spinner("🤔 Analyzing..."):
-                        result = ask_question(q, st.session_state.qa_pipeline)
+                        result = st.session_state.quick_answers.get(q) or ask_question(
+                            q, st.session_state.qa_pipeline, st.session_state.quick_q_vectors.get(q)
+                        )
                         st.markdown("""
                         <div class="answer-compact">
                             <div class="compact-title">💡 Answer</div>
@@ -6,5 +6,6 @@ This package contains utility modules for PDF processing and QA pipeline managem
 
 from .pdf_loader import PDFLoader
 from .qa_pipeline import QAPipeline
+from .embeddings import FastEmbedEmbeddings
 
-__all__ = ['PDFLoader', 'QAPipeline'] 
\ No newline at end of file
+__all__ = ['PDFLoader', 'QAPipeline', 'FastEmbedEmbeddings'] 
\ No newline at end of file
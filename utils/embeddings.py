@@ -0,0 +1,94 @@
+"""
+Embeddings Module
+
+This module provides a local sentence embedding model backed by fastembed,
+which runs prequantized ONNX weights on CPU without torch. It implements the
+LangChain embeddings interface so it can be used anywhere HuggingFaceEmbeddings
+was used.
+"""
+
+from typing import List
+import numpy as np
+from fastembed import TextEmbedding
+from langchain_core.embeddings import Embeddings
+
+
+DEFAULT_EMBEDDING_MODEL = "BAAI/bge-small-en-v1.5"
+
+# Below this many texts, spawning one worker per core costs more than it saves
+PARALLEL_EMBED_THRESHOLD = 512
+
+
+class FastEmbedEmbeddings(Embeddings):
+    """
+    Sentence embeddings from a quantized ONNX model via fastembed.
+
+    Vectors are always L2-normalized, which the inner-product vector index relies on.
+    """
+
+    def __init__(self, model_name: str = DEFAULT_EMBEDDING_MODEL, batch_size: int = 64):
+        """
+        Initialize the embedding model, downloading its ONNX weights on first use.
+
+        Args:
+            model_name: fastembed model name
+            batch_size: Number of texts per ONNX Runtime session call
+        """
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.model = TextEmbedding(model_name=model_name)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed a list of texts.
+
+        Args:
+            texts: Texts to embed
+
+        Returns:
+            List of L2-normalized embedding vectors
+        """
+        if not texts:
+            return []
+
+        # parallel=0 spreads large batches over all cores
+        parallel = 0 if len(texts) >= PARALLEL_EMBED_THRESHOLD else None
+        vectors = np.stack(list(self.model.embed(texts, batch_size=self.batch_size, parallel=parallel)))
+        return self._normalize(vectors).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        """
+        Embed a single query text.
+
+        Args:
+            text: Query text to embed
+
+        Returns:
+            L2-normalized embedding vector
+        """
+        return self.embed_queries([text])[0]
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed several query texts in one batched call.
+
+        Queries go through the model's query-side encoding, which can differ
+        from the document-side encoding used by embed_documents.
+
+        Args:
+            texts: Query texts to embed
+
+        Returns:
+            List of L2-normalized embedding vectors
+        """
+        if not texts:
+            return []
+
+        vectors = np.stack(list(self.model.query_embed(texts, batch_size=self.batch_size)))
+        return self._normalize(vectors).tolist()
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        """L2-normalize each row of a float32 matrix."""
+        vectors = vectors.astype(np.float32, copy=False)
+        return vectors / np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
@@ -7,30 +7,74 @@ manageable text chunks for vector storage and retrieval.
 """
 
 import os
-from typing import List, Optional
+import re
+from typing import List, Optional, Tuple, Union
 from pathlib import Path
-import PyPDF2
+import pymupdf
+import pymupdf4llm
+import tiktoken
+from datasketch import MinHash, MinHashLSH
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
+# Valid PDFs carry this marker near the start of the file (readers allow leading junk)
+PDF_HEADER = b"%PDF-"
+HEADER_SEARCH_BYTES = 1024
+
+# Chunks whose word 3-gram Jaccard similarity to an earlier chunk reaches this are dropped
+DEDUP_THRESHOLD = 0.85
+MINHASH_PERMUTATIONS = 128
+# 16 bands of 8 rows flag a pair at the threshold as a candidate 99% of the time;
+# candidates are then checked against the estimated Jaccard similarity
+MINHASH_LSH_BANDS = 16
+
+# Tokenizer used to size chunks, matching the OpenAI-compatible LLM
+TOKEN_ENCODING = "cl100k_base"
+DOC_PREFIX_TOKENS = 128
+HEADING_PATTERN = re.compile(r"^(#{1,6})\s+(.+?)\s*#*\s*$", re.MULTILINE)
+
+
+def _has_pdf_header(data: bytes) -> bool:
+    """Check the leading bytes of a file for the PDF header."""
+    return PDF_HEADER in data[:HEADER_SEARCH_BYTES]
+
+
+def _open_document(source: Union[str, bytes]) -> pymupdf.Document:
+    """Open a PDF from a file path or from in-memory bytes."""
+    if isinstance(source, bytes):
+        return pymupdf.open(stream=source, filetype="pdf")
+    return pymupdf.open(source)
+
 
 class PDFLoader:
     """Handles PDF file loading and text chunking operations."""
     
-    def __init__(self, chunk_size: int = 500, chunk_overlap: int = 50):
+    def __init__(
+        self,
+        chunk_size: int = 384,
+        chunk_overlap: int = 48,
+        use_markdown: bool = False,
+        deduplicate: bool = True
+    ):
         """
         Initialize the PDF loader with chunking parameters.
         
         Args:
-            chunk_size: Maximum size of each text chunk in characters
-            chunk_overlap: Number of characters to overlap between chunks
+            chunk_size: Maximum size of each text chunk in tokens; kept well under the
+                embedding model's 512-token window, whose tokenizer splits text more finely
+            chunk_overlap: Number of tokens to overlap between chunks
+            use_markdown: Render pages as structure-aware markdown instead of plain text
+            deduplicate: Drop near-duplicate chunks such as repeated headers and footers
         """
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
-        self.text_splitter = RecursiveCharacterTextSplitter(
+        self.use_markdown = use_markdown
+        self.deduplicate = deduplicate
+        self.encoding = tiktoken.get_encoding(TOKEN_ENCODING)
+        self.text_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+            encoding_name=TOKEN_ENCODING,
             chunk_size=chunk_size,
             chunk_overlap=chunk_overlap,
-            length_function=len,
-            separators=["\n\n", "\n", " ", ""]
+            separators=["\n\n", "\n", ". ", " ", ""]
         )
     
     def load_pdf(self, file_path: str) -> List[str]:
@@ -47,39 +91,266 @@ class PDFLoader:
             FileNotFoundError: If the PDF file doesn't exist
             ValueError: If the PDF is empty or invalid
         """
-        if not os.path.exists(file_path):
-            raise FileNotFoundError(f"PDF file not found: {file_path}")
+        return self.split_pages(self.extract_pages(file_path))
+    
+    def load_pdf_bytes(self, data: bytes) -> List[str]:
+        """
+        Load and extract text from in-memory PDF bytes, then split into chunks.
         
+        Args:
+            data: Raw PDF file content
+            
+        Returns:
+            List of text chunks
+            
+        Raises:
+            ValueError: If the PDF is empty or invalid
+        """
+        return self.split_pages(self.extract_pages_bytes(data))
+    
+    def extract_pages(self, file_path: str) -> List[str]:
+        """
+        Extract the text of each page of a PDF file.
+        
+        Args:
+            file_path: Path to the PDF file
+            
+        Returns:
+            Text of each page, in page order
+            
+        Raises:
+            FileNotFoundError: If the PDF file doesn't exist
+            ValueError: If the PDF is empty or invalid
+        """
         if not file_path.lower().endswith('.pdf'):
             raise ValueError(f"File must be a PDF: {file_path}")
         
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(f"PDF file not found: {file_path}")
+        
+        # Reject non-PDFs before handing them to the parser
+        with open(file_path, 'rb') as file:
+            if not _has_pdf_header(file.read(HEADER_SEARCH_BYTES)):
+                raise ValueError(f"Not a valid PDF file: {file_path}")
+        
+        return self._extract_document(file_path)
+    
+    def extract_pages_bytes(self, data: bytes) -> List[str]:
+        """
+        Extract the text of each page of an in-memory PDF.
+        
+        Args:
+            data: Raw PDF file content
+            
+        Returns:
+            Text of each page, in page order
+            
+        Raises:
+            ValueError: If the PDF is empty or invalid
+        """
+        if not data:
+            raise ValueError("PDF file is empty")
+        
+        # Reject non-PDFs before handing them to the parser
+        if not _has_pdf_header(data):
+            raise ValueError("Not a valid PDF file")
+        
+        return self._extract_document(data)
+    
+    def split_pages(self, page_texts: List[str]) -> List[str]:
+        """
+        Split extracted page texts into chunks.
+        
+        Args:
+            page_texts: Text of each page, in page order
+            
+        Returns:
+            List of text chunks
+            
+        Raises:
+            ValueError: If no chunks could be created
+        """
+        return [chunk for _, chunk in self.split_pages_with_headings(page_texts)]
+    
+    def split_pages_with_headings(self, page_texts: List[str]) -> List[Tuple[str, str]]:
+        """
+        Split extracted page texts into chunks tagged with their markdown heading path.
+        
+        The heading path is kept apart from the chunk text so it is not embedded
+        and can be added back when the chunk is placed in a prompt.
+        
+        Args:
+            page_texts: Text of each page, in page order
+            
+        Returns:
+            List of (heading path, chunk) tuples; the path is empty for plain text
+            
+        Raises:
+            ValueError: If no chunks could be created
+        """
+        # Split each page (or markdown section) separately instead of joining the whole document
+        sections = []
+        for heading_path, text in self._split_sections(page_texts):
+            sections.extend((heading_path, chunk) for chunk in self.text_splitter.split_text(text))
+        sections = self._merge_small_chunks(sections)
+        if self.deduplicate:
+            sections = self._drop_near_duplicates(sections)
+        
+        if not sections:
+            raise ValueError("Failed to create text chunks")
+        
+        return sections
+    
+    def count_tokens(self, text: str) -> int:
+        """
+        Count tokens with the same encoding used for chunking.
+        
+        Args:
+            text: Text to measure
+            
+        Returns:
+            Number of tokens
+        """
+        return len(self.encoding.encode(text))
+    
+    def _extract_document(self, source: Union[str, bytes]) -> List[str]:
+        """
+        Extract page texts from a PDF given as a file path or as bytes.
+        
+        Args:
+            source: Path to the PDF file or raw PDF content
+            
+        Returns:
+            Text of each page, in page order
+            
+        Raises:
+            ValueError: If the PDF is damaged, empty or has no text
+        """
         try:
-            with open(file_path, 'rb') as file:
-                pdf_reader = PyPDF2.PdfReader(file)
-                
-                if len(pdf_reader.pages) == 0:
-                    raise ValueError("PDF file is empty")
-                
-                # Extract text from all pages
-                text_content = ""
-                for page in pdf_reader.pages:
-                    page_text = page.extract_text()
-                    if page_text:
-                        text_content += page_text + "\n"
-                
-                if not text_content.strip():
-                    raise ValueError("No text content found in PDF")
-                
-                # Split text into chunks
-                chunks = self.text_splitter.split_text(text_content)
-                
-                if not chunks:
-                    raise ValueError("Failed to create text chunks")
-                
-                return chunks
-                
-        except Exception as e:
-            raise Exception(f"Error processing PDF: {str(e)}")
+            doc = _open_document(source)
+        except pymupdf.FileDataError as e:
+            raise ValueError(f"Invalid PDF: {str(e)}") from e
+        
+        try:
+            if doc.page_count == 0:
+                raise ValueError("PDF file is empty")
+            
+            if self.use_markdown:
+                # Structure-aware extraction (headings, lists, tables), one entry per page
+                page_texts = [page["text"] for page in pymupdf4llm.to_markdown(doc, page_chunks=True)]
+            else:
+                # Extract text from all pages. Serial on purpose: at ~1.5 ms per page even an
+                # 800-page PDF takes ~1 s, less than starting one spawned worker process
+                page_texts = [page.get_text("text") for page in doc]
+        finally:
+            doc.close()
+        
+        if not any(text.strip() for text in page_texts):
+            raise ValueError("No text content found in PDF")
+        
+        return page_texts
+    
+    def _split_sections(self, page_texts: List[str]) -> List[Tuple[str, str]]:
+        """
+        Split page texts into sections tagged with their markdown heading path.
+        
+        Args:
+            page_texts: Text of each page, in page order
+            
+        Returns:
+            List of (heading path, section text) tuples; the path is empty for plain text
+        """
+        if not self.use_markdown:
+            return [("", text) for text in page_texts if text.strip()]
+        
+        sections = []
+        headings: List[Tuple[int, str]] = []
+        for text in page_texts:
+            position = 0
+            for match in HEADING_PATTERN.finditer(text):
+                if text[position:match.start()].strip():
+                    sections.append((self._heading_path(headings), text[position:match.start()]))
+                # Headings at the same or deeper level are replaced by the new one
+                level = len(match.group(1))
+                headings = [h for h in headings if h[0] < level] + [(level, match.group(2).strip("*_ "))]
+                position = match.start()
+            if text[position:].strip():
+                sections.append((self._heading_path(headings), text[position:]))
+        return sections
+    
+    @staticmethod
+    def _heading_path(headings: List[Tuple[int, str]]) -> str:
+        """Join the active headings into a breadcrumb path."""
+        return " > ".join(title for _, title in headings)
+    
+    def _merge_small_chunks(self, chunks: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+        """
+        Merge short chunks left at page boundaries into their predecessor.
+        
+        Args:
+            chunks: (heading path, chunk) tuples produced page by page
+            
+        Returns:
+            Chunks with fragments under a quarter of chunk_size merged within the same section
+        """
+        min_size = self.chunk_size // 4
+        merged = []
+        for heading_path, chunk in chunks:
+            if merged and merged[-1][0] == heading_path:
+                previous = merged[-1][1]
+                previous_size = self.count_tokens(previous)
+                size = self.count_tokens(chunk)
+                if (size < min_size or previous_size < min_size) and previous_size + size <= self.chunk_size:
+                    merged[-1] = (heading_path, previous + "\n" + chunk)
+                    continue
+            merged.append((heading_path, chunk))
+        return merged
+    
+    def _drop_near_duplicates(self, chunks: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+        """
+        Drop chunks that are near-duplicates of an earlier chunk, using MinHash LSH.
+        
+        Args:
+            chunks: (heading path, chunk) tuples in document order
+            
+        Returns:
+            Chunks with near-duplicates removed, first occurrence kept
+        """
+        lsh = MinHashLSH(
+            num_perm=MINHASH_PERMUTATIONS,
+            params=(MINHASH_LSH_BANDS, MINHASH_PERMUTATIONS // MINHASH_LSH_BANDS)
+        )
+        minhashes = {}
+        unique = []
+        for index, (heading_path, chunk) in enumerate(chunks):
+            # Hash lowercased word 3-grams of the chunk body
+            words = chunk.lower().split()
+            shingles = {" ".join(words[i:i + 3]) for i in range(max(len(words) - 2, 1))}
+            minhash = MinHash(num_perm=MINHASH_PERMUTATIONS)
+            minhash.update_batch([shingle.encode("utf-8") for shingle in shingles])
+            
+            # LSH only returns candidates; confirm the similarity before dropping the chunk
+            if any(minhash.jaccard(minhashes[key]) >= DEDUP_THRESHOLD for key in lsh.query(minhash)):
+                continue
+            minhashes[str(index)] = minhash
+            lsh.insert(str(index), minhash)
+            unique.append((heading_path, chunk))
+        return unique
+    
+    def document_prefix(self, page_texts: List[str]) -> str:
+        """
+        Build a short document prefix from the opening text of the PDF.
+        
+        Args:
+            page_texts: Text of each page, in page order
+            
+        Returns:
+            The first DOC_PREFIX_TOKENS tokens of the document on a single line
+        """
+        opening_pages = [text for text in page_texts if text.strip()][:2]
+        opening = " ".join(" ".join(text.split()) for text in opening_pages)
+        return self.encoding.decode(self.encoding.encode(opening)[:DOC_PREFIX_TOKENS])
+    
     def get_chunk_info(self, chunks: List[str]) -> dict:
         """
         Get information about the created chunks.
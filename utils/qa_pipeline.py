@@ -2,32 +2,103 @@
 QA Pipeline Module
 
 This module handles the question-answering pipeline including:
-- Text embedding using HuggingFace sentence-transformers (free, local)
+- Text embedding using a quantized bge-small model via fastembed (free, local)
 - Vector storage with ChromaDB
 - Retrieval and answer generation using OpenRouter (Mistral-7B)
+- Cache-augmented generation for documents that fit in the LLM context
 """
 
 import os
-from typing import List, Optional
-from langchain_community.embeddings import HuggingFaceEmbeddings
+import functools
+import hashlib
+from operator import itemgetter
+from typing import Callable, List, Optional, Tuple
+import httpx
+import numpy as np
+from langchain_core.embeddings import Embeddings
 from langchain_openai import ChatOpenAI
 from langchain_community.vectorstores import Chroma
 from langchain.chains import RetrievalQA
-from langchain.prompts import PromptTemplate
+from langchain.prompts import ChatPromptTemplate, PromptTemplate
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import SystemMessage
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import Runnable, RunnableLambda
 from pydantic import SecretStr
 import chromadb
-import uuid
+from .embeddings import DEFAULT_EMBEDDING_MODEL, FastEmbedEmbeddings
+
+# Cosine similarity above which a previous answer is reused for a new question
+SEMANTIC_CACHE_THRESHOLD = 0.92
+SEMANTIC_CACHE_SIZE = 256
+
+# Invariant instructions sent as the system message; keep it token-identical across calls
+# so provider-side prompt prefix caches can reuse it
+SYSTEM_PROMPT = """You are a document analysis assistant answering questions about a single PDF.
+Answer using only the document content you are given.
+If the document content does not contain the answer, say that you don't know; don't try to make up an answer.
+Be concise and factual, and quote figures, names and terms exactly as they appear in the document.
+When passages of the document disagree, say so instead of picking one."""
+
+# Context window of the LLM, in its own tokens (32k for the default Mistral model)
+LLM_CONTEXT_TOKENS = int(os.getenv("LLM_CONTEXT_TOKENS", "32768"))
+# Documents are measured in cl100k_base tokens; SentencePiece tokenizers such as
+# Mistral's produce up to ~1.35x as many on English prose
+CAG_TOKEN_RATIO = 1.35
+# Room kept free for the system prompt, question and answer
+CAG_RESERVE_TOKENS = 4096
+
+# Documents up to this many cl100k_base tokens are answered from the full text instead of
+# retrieval (cache-augmented generation): ratio * tokens <= context - reserve
+CAG_MAX_TOKENS = int(os.getenv(
+    "CAG_MAX_TOKENS",
+    (LLM_CONTEXT_TOKENS - CAG_RESERVE_TOKENS) / CAG_TOKEN_RATIO
+))
+
+# MMR drops near-duplicate chunks so the prompt carries less redundant context
+RETRIEVER_SEARCH_KWARGS = {"k": 3, "fetch_k": 10, "lambda_mult": 0.5}
+
+# HNSW settings sized for single-document collections (well under 10k chunks).
+# Embeddings are unit-length, so inner product ranks exactly like cosine without per-query normalization
+HNSW_METADATA = {
+    "hnsw:space": "ip",
+    "hnsw:construction_ef": 40,
+    "hnsw:M": 12,
+    "hnsw:search_ef": 32
+}
+
+# Retrieved chunks are shown to the LLM with the heading path stored alongside them
+SECTION_DOCUMENT_PROMPT = PromptTemplate.from_template("Section: {section}\n{page_content}")
+
+
+@functools.lru_cache(maxsize=4)
+def _get_embeddings(model_name: str) -> FastEmbedEmbeddings:
+    """Load an embedding model once per process and reuse it across pipelines."""
+    return FastEmbedEmbeddings(model_name=model_name)
+
+
+class _TokenCallback(BaseCallbackHandler):
+    """Forward each token generated by the LLM to a callback."""
+    
+    def __init__(self, on_token: Callable[[str], None]):
+        self.on_token = on_token
+    
+    def on_llm_new_token(self, token: str, **kwargs):
+        self.on_token(token)
 
 
 class QAPipeline:
-    """Handles the complete question-answering pipeline using OpenRouter and HuggingFace embeddings."""
+    """Handles the complete question-answering pipeline using OpenRouter and fastembed embeddings."""
     
     def __init__(
         self,
         api_key: Optional[str] = None,
         llm_base_url: Optional[str] = None,
         llm_model: Optional[str] = None,
-        embedding_model: str = "sentence-transformers/all-MiniLM-L6-v2"
+        embedding_model: str = DEFAULT_EMBEDDING_MODEL,
+        embeddings: Optional[Embeddings] = None,
+        persist_directory: str = ".chroma_cache",
+        http_client: Optional[httpx.Client] = None
     ):
         """
         Initialize the QA pipeline with LLM and embedding settings.
@@ -36,7 +107,10 @@ class QAPipeline:
             api_key: OpenRouter API key (from env if not provided)
             llm_base_url: Base URL for OpenRouter API (from env if not provided)
             llm_model: Model name for the LLM (from env if not provided)
-            embedding_model: HuggingFace embedding model name
+            embedding_model: fastembed embedding model name
+            embeddings: Preloaded embedding model (shared cached model if not provided)
+            persist_directory: Directory where ChromaDB persists document collections
+            http_client: Shared HTTP client for LLM requests (a new one if not provided)
         """
         self.api_key = api_key or os.getenv("OPENROUTER_API_KEY")
         self.llm_base_url = llm_base_url or os.getenv("LLM_BASE_URL", "https://openrouter.ai/api/v1")
@@ -46,10 +120,11 @@ class QAPipeline:
             raise ValueError("OpenRouter API key is required. Set OPENROUTER_API_KEY environment variable.")
         
         try:
-            # Initialize HuggingFace embeddings (free, no API key required)
-            self.embeddings = HuggingFaceEmbeddings(model_name=embedding_model)
+            # Reuse quantized ONNX embeddings (free, no API key required)
+            self.embeddings = embeddings or _get_embeddings(embedding_model)
+            self.embedding_model = getattr(self.embeddings, "model_name", embedding_model)
         except Exception as e:
-            raise ValueError(f"Failed to initialize embeddings: {str(e)}. Please ensure sentence-transformers is installed.")
+            raise ValueError(f"Failed to initialize embeddings: {str(e)}. Please ensure fastembed is installed.")
         
         try:
             # Initialize LLM (OpenAI-compatible, configurable)
@@ -57,20 +132,95 @@ class QAPipeline:
                 base_url=self.llm_base_url,
                 api_key=SecretStr(self.api_key),
                 model=self.llm_model,
-                temperature=0.1
+                temperature=0.1,
+                streaming=True,
+                http_client=http_client
             )
         except Exception as e:
             raise ValueError(f"Failed to initialize LLM: {str(e)}. Please check your OpenRouter API key and model configuration.")
         
+        try:
+            # Persistent ChromaDB client so embeddings survive reruns and re-uploads
+            self.chroma_client = chromadb.PersistentClient(path=persist_directory)
+        except Exception as e:
+            raise ValueError(f"Failed to initialize ChromaDB: {str(e)}")
+        
         self.vector_store = None
         self.qa_chain = None
+        self.document_text: Optional[str] = None
+        
+        # Semantic answer cache: (unit question vector, question, result), oldest first
+        self._answer_cache: List[Tuple[np.ndarray, str, dict]] = []
+        self._cache_matrix: Optional[np.ndarray] = None
+    
+    def fits_in_context(self, token_count: int) -> bool:
+        """
+        Check whether a document is small enough to send to the LLM in full.
+        
+        Args:
+            token_count: Number of tokens in the document text
+            
+        Returns:
+            True if setup_cag_pipeline should be used instead of retrieval
+        """
+        return token_count <= CAG_MAX_TOKENS
     
-    def setup_qa_pipeline(self, chunks: List[str]) -> RetrievalQA:
+    def setup_cag_pipeline(self, document_text: str) -> Runnable:
+        """
+        Set up cache-augmented generation: answer from the full document text, without retrieval.
+        
+        The document is placed in the system message so every question shares
+        the same prompt prefix, which the provider can keep in its KV cache.
+        
+        Args:
+            document_text: Full text of the document
+            
+        Returns:
+            Chain taking {"query": ...} and returning {"result": ..., "source_documents": []}
+        """
+        if not document_text.strip():
+            raise ValueError("No document text provided")
+        
+        # Answers cached for a previous document no longer apply
+        self._clear_answer_cache()
+        self.vector_store = None
+        self.document_text = document_text
+        
+        try:
+            answer_chain = (
+                {"question": itemgetter("query")}
+                | self._build_prompt(document_text)
+                | self.llm
+                | StrOutputParser()
+            )
+            # No parallel step: it would run the LLM on a worker thread, and Streamlit
+            # can only render streamed tokens from the script thread
+            self.qa_chain = answer_chain | RunnableLambda(
+                lambda text: {"result": text, "source_documents": []}
+            )
+        except Exception as e:
+            raise ValueError(f"Failed to create QA chain: {str(e)}")
+        
+        return self.qa_chain
+    
+    def setup_qa_pipeline(
+        self,
+        chunks: List[str],
+        collection_name: Optional[str] = None,
+        headings: Optional[List[str]] = None,
+        document_prefix: str = ""
+    ) -> RetrievalQA:
         """
         Set up the QA pipeline with the provided text chunks.
         
+        Only the chunk text is embedded; the heading paths and document prefix
+        are added to the prompt when chunks are retrieved.
+        
         Args:
             chunks: List of text chunks to embed and store
+            collection_name: Name of the persisted collection (derived from the chunks if not provided)
+            headings: Heading path of each chunk, stored as metadata
+            document_prefix: Opening text of the document, included with every question
             
         Returns:
             Configured RetrievalQA chain
@@ -78,31 +228,47 @@ class QAPipeline:
         if not chunks:
             raise ValueError("No text chunks provided")
         
+        headings = headings or [""] * len(chunks)
+        if len(headings) != len(chunks):
+            raise ValueError("Each chunk needs one heading path")
+        
+        # Answers cached for a previous document no longer apply
+        self._clear_answer_cache()
+        self.document_text = None
+        
         try:
-            # Create vector store with ChromaDB (in-memory)
-            collection_name = f"pdf_qa_collection_{uuid.uuid4().hex[:8]}"
-            self.vector_store = Chroma.from_texts(
-                texts=chunks,
-                embedding=self.embeddings,
-                collection_name=collection_name
+            chunks_hash = hashlib.sha256("\n".join(headings + chunks).encode("utf-8")).hexdigest()
+            if collection_name is None:
+                collection_name = f"pdf_{chunks_hash[:16]}"
+            
+            # Only embed when this document has not been indexed with the same chunks, model and settings before
+            metadata = {"chunks_hash": chunks_hash, "embedding_model": self.embedding_model, **HNSW_METADATA}
+            collection = self.chroma_client.get_or_create_collection(name=collection_name)
+            existing = collection.metadata or {}
+            if collection.count() == 0 or any(existing.get(key) != value for key, value in metadata.items()):
+                self.chroma_client.delete_collection(name=collection_name)
+                collection = self.chroma_client.create_collection(name=collection_name, metadata=metadata)
+                # Embed all chunks in one batched forward pass
+                collection.add(
+                    ids=[str(i) for i in range(len(chunks))],
+                    embeddings=self.embeddings.embed_documents(chunks),
+                    documents=chunks,
+                    metadatas=[{"section": heading} for heading in headings]
+                )
+            
+            self.vector_store = Chroma(
+                client=self.chroma_client,
+                collection_name=collection_name,
+                embedding_function=self.embeddings
             )
         except Exception as e:
             raise ValueError(f"Failed to create vector store: {str(e)}")
         
-        # Create custom prompt template
-        prompt_template = """Use the following context to answer the question at the end. 
-        If you don't know the answer, just say that you don't know, don't try to make up an answer.
-        
-        Context: {context}
-        
-        Question: {question}
-        
-        Answer:"""
-        
-        prompt = PromptTemplate(
-            template=prompt_template,
-            input_variables=["context", "question"]
-        )
+        # Static instructions first, so every request shares the same cacheable prompt prefix
+        prompt = self._build_prompt(document_prefix=document_prefix)
+        chain_type_kwargs = {"prompt": prompt}
+        if any(headings):
+            chain_type_kwargs["document_prompt"] = SECTION_DOCUMENT_PROMPT
         
         try:
             # Create RetrievalQA chain
@@ -110,10 +276,10 @@ class QAPipeline:
                 llm=self.llm,
                 chain_type="stuff",
                 retriever=self.vector_store.as_retriever(
-                    search_type="similarity",
-                    search_kwargs={"k": 3}
+                    search_type="mmr",
+                    search_kwargs=RETRIEVER_SEARCH_KWARGS
                 ),
-                chain_type_kwargs={"prompt": prompt},
+                chain_type_kwargs=chain_type_kwargs,
                 return_source_documents=True
             )
         except Exception as e:
@@ -121,54 +287,286 @@ class QAPipeline:
         
         return self.qa_chain
     
-    def query_chain(self, question: str) -> dict:
+    def _build_prompt(self, document_text: Optional[str] = None, document_prefix: str = "") -> ChatPromptTemplate:
+        """
+        Build the chat prompt with a fixed system prefix followed by the variable input.
+        
+        Args:
+            document_text: Full document to embed in the system message (CAG mode);
+                retrieved context is passed per question when omitted
+            document_prefix: Opening text of the document to embed in the system message
+                in retrieval mode
+        
+        Returns:
+            Prompt template with "context" and "question" inputs, or only "question" in CAG mode
+        """
+        system_text = SYSTEM_PROMPT
+        if document_text is not None:
+            system_text += f"\n\nDocument:\n{document_text}"
+        elif document_prefix:
+            # Fixed for the whole document, so the system message stays cacheable across questions
+            system_text += f"\n\nDocument opening:\n{document_prefix}"
+        
+        if self.llm_model.startswith("anthropic/"):
+            # Anthropic models only cache prefixes that are explicitly marked
+            system_message = SystemMessage(content=[
+                {"type": "text", "text": system_text, "cache_control": {"type": "ephemeral"}}
+            ])
+        else:
+            system_message = SystemMessage(content=system_text)
+        
+        if document_text is not None:
+            human_template = "Question: {question}"
+        else:
+            human_template = "Context:\n{context}\n\nQuestion: {question}"
+        
+        return ChatPromptTemplate.from_messages([system_message, ("human", human_template)])
+    
+    def query_chain(self, question: str, on_token: Optional[Callable[[str], None]] = None) -> dict:
         """
         Query the QA chain with a question.
         
+        Args:
+            question: The question to ask
+            on_token: Called with each answer token as it is generated (not called for cached answers)
+            
+        Returns:
+            Dictionary containing answer and source documents
+        """
+        self._validate_question(question)
+        
+        try:
+            q_vec = self._embed_question(question)
+        except Exception as e:
+            return self._error_result(e)
+        
+        return self.query_with_vector(question, q_vec, on_token=on_token)
+    
+    async def aquery_chain(self, question: str) -> dict:
+        """
+        Query the QA chain asynchronously, so several questions can run concurrently.
+        
         Args:
             question: The question to ask
             
         Returns:
             Dictionary containing answer and source documents
         """
+        self._validate_question(question)
+        
+        try:
+            q_vec = self._embed_question(question)
+        except Exception as e:
+            return self._error_result(e)
+        
+        return await self.aquery_with_vector(question, q_vec)
+    
+    def query_with_vector(
+        self,
+        question: str,
+        q_vec: List[float],
+        on_token: Optional[Callable[[str], None]] = None
+    ) -> dict:
+        """
+        Answer a question whose embedding is already known, without embedding it again.
+        
+        The vector is used both for the semantic answer cache and for retrieval.
+        
+        Args:
+            question: The question to ask
+            q_vec: Embedding of the question (e.g. from embed_questions)
+            on_token: Called with each answer token as it is generated (not called for cached answers)
+            
+        Returns:
+            Dictionary containing answer and source documents
+        """
+        self._validate_question(question)
+        
+        try:
+            # Reuse the answer of a semantically equivalent earlier question
+            q_vec = self._as_unit_vector(q_vec)
+            cached = self._lookup_answer(q_vec)
+            if cached is not None:
+                return cached
+            
+            # Get answer from chain
+            config = {"callbacks": [_TokenCallback(on_token)]} if on_token else None
+            if self.vector_store is None:
+                result = self.qa_chain.invoke({"query": question}, config=config)
+            else:
+                # Search by vector so the retriever does not re-embed the question
+                docs = self.vector_store.max_marginal_relevance_search_by_vector(
+                    q_vec.tolist(), **RETRIEVER_SEARCH_KWARGS
+                )
+                output = self.qa_chain.combine_documents_chain.invoke(
+                    {"input_documents": docs, "question": question}, config=config
+                )
+                result = {"result": output["output_text"], "source_documents": docs}
+            
+            response = self._format_result(result)
+            self._store_answer(q_vec, question, response)
+            return response
+            
+        except Exception as e:
+            return self._error_result(e)
+    
+    async def aquery_with_vector(self, question: str, q_vec: List[float]) -> dict:
+        """
+        Asynchronous variant of query_with_vector.
+        
+        Args:
+            question: The question to ask
+            q_vec: Embedding of the question (e.g. from embed_questions)
+            
+        Returns:
+            Dictionary containing answer and source documents
+        """
+        self._validate_question(question)
+        
+        try:
+            q_vec = self._as_unit_vector(q_vec)
+            cached = self._lookup_answer(q_vec)
+            if cached is not None:
+                return cached
+            
+            if self.vector_store is None:
+                result = await self.qa_chain.ainvoke({"query": question})
+            else:
+                docs = await self.vector_store.amax_marginal_relevance_search_by_vector(
+                    q_vec.tolist(), **RETRIEVER_SEARCH_KWARGS
+                )
+                output = await self.qa_chain.combine_documents_chain.ainvoke(
+                    {"input_documents": docs, "question": question}
+                )
+                result = {"result": output["output_text"], "source_documents": docs}
+            
+            response = self._format_result(result)
+            self._store_answer(q_vec, question, response)
+            return response
+            
+        except Exception as e:
+            return self._error_result(e)
+    
+    def embed_questions(self, questions: List[str]) -> List[np.ndarray]:
+        """
+        Embed several questions in one batched call, for later use with query_with_vector.
+        
+        Args:
+            questions: Questions to embed
+            
+        Returns:
+            Unit-length float32 vector for each question, in order
+        """
+        # Questions must be embedded query-side, like typed questions, to match the cache and retrieval
+        if isinstance(self.embeddings, FastEmbedEmbeddings):
+            vectors = self.embeddings.embed_queries(questions)
+        else:
+            vectors = [self.embeddings.embed_query(question) for question in questions]
+        return [self._as_unit_vector(vector) for vector in vectors]
+    
+    def _validate_question(self, question: str):
+        """Ensure the pipeline is set up and the question is not blank."""
         if not self.qa_chain:
             raise ValueError("QA pipeline not initialized. Call setup_qa_pipeline first.")
         
         if not question.strip():
             raise ValueError("Question cannot be empty")
+    
+    def _embed_question(self, question: str) -> np.ndarray:
+        """Embed a question as a unit-length float32 vector."""
+        return self._as_unit_vector(self.embeddings.embed_query(question))
+    
+    def _format_result(self, result: dict) -> dict:
+        """
+        Convert a RetrievalQA result into the answer dictionary shown in the UI.
         
-        try:
-            # Get answer from chain
-            result = self.qa_chain({"query": question})
-            
-            # Extract answer and sources
-            answer = result.get("result", "No answer generated")
-            source_documents = result.get("source_documents", [])
-            
-            # Format source information
-            sources = []
-            for doc in source_documents:
-                if hasattr(doc, 'page_content'):
-                    # Truncate source content for display
-                    content = doc.page_content[:200] + "..." if len(doc.page_content) > 200 else doc.page_content
-                    sources.append(content)
-                elif hasattr(doc, 'content'):
-                    # Alternative attribute name
-                    content = doc.content[:200] + "..." if len(doc.content) > 200 else doc.content
-                    sources.append(content)
+        Args:
+            result: Raw chain output with "result" and "source_documents"
             
-            return {
-                "answer": answer,
-                "sources": sources,
-                "source_count": len(sources)
-            }
+        Returns:
+            Dictionary containing answer and truncated sources
+        """
+        # Extract answer and sources
+        answer = result.get("result", "No answer generated")
+        source_documents = result.get("source_documents", [])
+        
+        # Format source information
+        sources = []
+        for doc in source_documents:
+            if hasattr(doc, 'page_content'):
+                # Truncate source content for display
+                content = doc.page_content[:200] + "..." if len(doc.page_content) > 200 else doc.page_content
+                sources.append(content)
+            elif hasattr(doc, 'content'):
+                # Alternative attribute name
+                content = doc.content[:200] + "..." if len(doc.content) > 200 else doc.content
+                sources.append(content)
+        
+        return {
+            "answer": answer,
+            "sources": sources,
+            "source_count": len(sources)
+        }
+    
+    @staticmethod
+    def _as_unit_vector(vector: List[float]) -> np.ndarray:
+        """Convert an embedding to a unit-length float32 array."""
+        q_vec = np.array(vector, dtype=np.float32)
+        q_vec /= max(float(np.linalg.norm(q_vec)), 1e-12)
+        return q_vec
+    
+    @staticmethod
+    def _error_result(error: Exception) -> dict:
+        """Build the result dictionary returned when answering fails."""
+        return {
+            "answer": f"Error processing question: {str(error)}",
+            "sources": [],
+            "source_count": 0
+        }
+    
+    def _lookup_answer(self, q_vec: np.ndarray) -> Optional[dict]:
+        """
+        Find a cached answer whose question is similar enough to the query.
+        
+        Args:
+            q_vec: Unit-length float32 question embedding
             
-        except Exception as e:
-            return {
-                "answer": f"Error processing question: {str(e)}",
-                "sources": [],
-                "source_count": 0
-            }
+        Returns:
+            The cached result dictionary, or None on a miss
+        """
+        if self._cache_matrix is None:
+            return None
+        
+        # One matrix-vector product scores every cached question
+        scores = self._cache_matrix @ q_vec
+        best = int(np.argmax(scores))
+        if scores[best] < SEMANTIC_CACHE_THRESHOLD:
+            return None
+        
+        # Move the hit to the most recently used position
+        entry = self._answer_cache.pop(best)
+        self._answer_cache.append(entry)
+        self._rebuild_cache_matrix()
+        return entry[2]
+    
+    def _store_answer(self, q_vec: np.ndarray, question: str, result: dict):
+        """Add an answer to the semantic cache, evicting the least recently used entry."""
+        self._answer_cache.append((q_vec, question, result))
+        if len(self._answer_cache) > SEMANTIC_CACHE_SIZE:
+            self._answer_cache.pop(0)
+        self._rebuild_cache_matrix()
+    
+    def _rebuild_cache_matrix(self):
+        """Stack cached question vectors into a contiguous (N, dim) float32 matrix."""
+        self._cache_matrix = np.ascontiguousarray(
+            np.stack([entry[0] for entry in self._answer_cache]),
+            dtype=np.float32
+        ) if self._answer_cache else None
+    
+    def _clear_answer_cache(self):
+        """Drop all cached answers."""
+        self._answer_cache = []
+        self._cache_matrix = None
     
     def get_vector_store_info(self) -> dict:
         """
@@ -193,15 +591,8 @@ class QAPipeline:
             return {"total_documents": 0}
     
     def clear_vector_store(self):
-        """Clear the current vector store."""
-        if self.vector_store:
-            try:
-                # Delete the collection
-                collection = self.vector_store._collection
-                # Use the client to delete the collection
-                client = chromadb.Client()
-                client.delete_collection(name=collection.name)
-                self.vector_store = None
-                self.qa_chain = None
-            except Exception:
-                pass 
\ No newline at end of file
+        """Release the current vector store or document text, keeping persisted embeddings for re-uploads."""
+        self.vector_store = None
+        self.document_text = None
+        self.qa_chain = None
+        self._clear_answer_cache()
\ No newline at end of file